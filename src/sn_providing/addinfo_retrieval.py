@@ -1,36 +1,62 @@
 import os
+import re
+import pickle
+import hashlib
+import sys
+import asyncio
+import contextlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from functools import partial
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
 from pathlib import Path
+from typing import Callable
+import faiss
+import httpx
+import numpy as np
 from tap import Tap
 from loguru import logger
 from dotenv import load_dotenv
+from openai import RateLimitError
 
 from langchain_openai import ChatOpenAI as LangChainOpenAI
 from langchain_core.documents import (
     Document,
 )
 from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable, RunnableBranch, RunnableConfig, RunnableLambda
+from langchain_core.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.retrievers import TFIDFRetriever
+from langchain_community.retrievers import TFIDFRetriever, BM25Retriever
 from langchain_core.prompts import PromptTemplate
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_openai.embeddings import OpenAIEmbeddings
 
 
-from sn_providing.entity import SpottingDataList, ReferenceDoc, RetrieverType
+from sn_providing.entity import SpottingDataList, ReferenceDoc, RetrieverType, IndexType
+from sn_providing.semantic_cache import SemanticCache
 
 #　(project-root)/.env を読み込む
 load_dotenv()
 
-# llama_index,langchain のログを標準出力に出す
-logging.basicConfig(
-    level=logging.DEBUG, 
-    filename="logs/{}.log".format(datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+# langchain 等のログをファイルに出す
+# ファイルへの書き込みはリクエストを投げるスレッドではなく QueueListener のスレッドで行う
+_log_queue = SimpleQueue()
+_log_listener = QueueListener(
+    _log_queue,
+    logging.FileHandler("logs/{}.log".format(datetime.now().strftime("%Y-%m-%d-%H-%M-%S")))
 )
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 
 
@@ -39,25 +65,84 @@ class Arguments(Tap):
     input_file: str
     output_file: str
     retriever_type: RetrieverType = "tfidf"
+    index_type: IndexType = "flat" # openai-embedding の場合の FAISS インデックス
+    reuse_splits: bool = False # 知識ベースが変わっていなければ分割済みの文書を再利用する
+    verbose: bool = False # プロンプトと検索した文書を DEBUG レベルでログに出す
+    resume: bool = False # output_file にある生成済みのスポッティングを飛ばして追記する (指定しない場合は作り直す)
+    cheap_model: str | None = None # 指定した場合、検索スコアが高いクエリはこのモデルで生成する (例: gpt-4o-mini, openai-embedding のみ)
     no_retrieval: bool = False
     reference_documents_yaml: str | None = None
+    concurrency: int = 16 # LLM への同時リクエスト数 (1 なら逐次実行)
+    stream: bool = False # 生成結果をストリーミングで標準出力に書き出す
+    cache_path: str = ".cache/langchain_addinfo.db" # LLM応答キャッシュ (sqlite のパス or redis:// URL)
+    no_cache: bool = False
+    semantic_cache_threshold: float | None = None # 指定した場合、cos類似度がこの値以上のプロンプトの応答を再利用する
 
 # constants
 MODEL_CONFIG = {
     "model": "gpt-4o",
     "temperature": 0,
+    # 固定の user を渡し、同じ接頭辞のリクエストが同じキャッシュに振り分けられるようにする
+    "model_kwargs": {"user": "sn-providing-addinfo"},
 }
 
 EMBEDDING_CONFIG = {
+    # SEARCH_CONFIG の score_threshold はこのモデルの類似度の分布に合わせてある
     "model": "text-embedding-ada-002",
+    # 1リクエストあたりのテキスト数 (1000文字の分割 x 1000件で 1リクエストのトークン上限に収まる)
     "chunk_size": 1000,
 }
 
+# インデックス構築時に並行して投げる埋め込みリクエスト数
+EMBEDDING_CONCURRENCY = 8
+
 SEARCH_CONFIG = {
     "k": 10,
     "score_threshold": 0.7,
 }
 
+# FAISS の近似近傍探索インデックスの設定
+HNSW_CONFIG = {
+    "M": 32,
+    "ef_construction": 200,
+    "ef_search": 64,
+}
+
+# 文書数が多く (>100K) 全件との距離計算が重い場合用
+IVFPQ_CONFIG = {
+    "nlist": 1024,
+    "m": 16, # 埋め込みの次元数を割り切る必要がある
+    "nbits": 8,
+    "nprobe": 16,
+    # PQ の近似距離で k * k_factor 件の候補を取り、元のベクトルとの L2 距離で並べ直す
+    "k_factor": 4,
+}
+# FAISS の k-means が推奨する、セントロイドあたりの学習データ数
+FAISS_MIN_POINTS_PER_CENTROID = 39
+
+# cheap_model を使う条件と、MODEL_CONFIG のモデルでやり直す条件
+# tfidf/bm25 は常に k 件返すので件数では判定できず、openai-embedding の関連度スコアで判定する
+ROUTING_CONFIG = {
+    # 最上位の文書の関連度スコアがこの値以上なら cheap_model を使う (検索の閾値 0.7 より厳しくする)
+    "min_top_score": 0.8,
+    "hedge_markers": ("i don't know", "i do not know", "i'm not sure", "not enough information"),
+}
+
+# BM25 でスコア計算に使うクエリ語数の上限 (IDF 上位のみ残す)
+BM25_MAX_QUERY_TERMS = 32
+
+# OpenAI API への HTTP 接続は 1回の run_langchain の中で使い回す (リクエストごとの TCP/TLS ハンドシェイクを省く)
+HTTP_CLIENT_CONFIG = {
+    "http2": True,
+    "limits": httpx.Limits(max_keepalive_connections=32, max_connections=64),
+}
+
+# レートリミット(429)時の再試行設定
+RETRY_CONFIG = {
+    "stop_after_attempt": 6,
+    "wait_exponential_jitter": True,
+}
+
 INSTRUCTION = \
 """You are a professional color commentator for a live broadcast of soccer. 
 Using the documents below, 
@@ -65,138 +150,457 @@ provide just one comment with a fact, such as player records or team statistics,
 The comment should be clear, accurate, and suitable for live commentary. 
 The game date will be given as YYYY-MM-DD. Do not use information dated after this.
 This comment should be natural comments following the previous comments given to the prompt."""
-# No retrievalの場合のプロンプト
-prompt_template_no_retrieval = \
-"""{instruction}
+# No retrievalの場合は文書に関する指示を除く
+INSTRUCTION_NO_RETRIEVAL = INSTRUCTION.replace("Using the documents below,", "")
 
-===
+# 全リクエストで共通の接頭辞 (指示文 + 区切り) は一度だけ組み立てる
+# 可変部分 (documents, query) は必ずこの後ろに置き、プロバイダ側の prompt prefix caching に乗せる
+_PROMPT_PREFIX = f"{INSTRUCTION}\n\n"
+_PROMPT_PREFIX_NO_RETRIEVAL = f"{INSTRUCTION_NO_RETRIEVAL}\n\n"
+
+# No retrievalの場合のプロンプト
+prompt_template_no_retrieval = _PROMPT_PREFIX_NO_RETRIEVAL + \
+"""===
 {query}
 
 Comment:"""
 
 # documentが与えられる場合のプロンプト
-prompt_template = \
-"""{instruction}
-
-===documents
+prompt_template = _PROMPT_PREFIX + \
+"""===documents
 {documents}
 ===
 {query}
 
 Comment:"""
 
+# テンプレートの解析はモジュールの読み込み時に一度だけ行い、各チェーンで使い回す
+_PROMPT = PromptTemplate.from_template(prompt_template)
+_PROMPT_NO_RETRIEVAL = PromptTemplate.from_template(prompt_template_no_retrieval)
+
 # 知識ベースのデータ保存場所
 DOCUMENT_DIR = Path("./data/addinfo_retrieval")
 
 # langchainのデータ構造保存場所
 PERSIST_LANGCHAIN_DIR = Path("./storage/langchain-embedding-ada002")
 
+# LLM応答キャッシュの保存場所
+LLM_CACHE_PATH = ".cache/langchain_addinfo.db"
+SEMANTIC_CACHE_DIR = Path(".cache/semantic")
+
+# 分割済み文書のキャッシュの保存場所
+SPLITS_CACHE_DIR = Path(".cache/splits")
+
 
 
 def run_langchain(
     spotting_data_list: SpottingDataList, 
     output_file: str, retriever_type: RetrieverType,
     no_retrieval: bool = False,
-    reference_documents_yaml: str | None = None
+    reference_documents_yaml: str | None = None,
+    concurrency: int = 16,
+    cache_path: str | None = LLM_CACHE_PATH,
+    semantic_cache_threshold: float | None = None,
+    stream: bool = False,
+    index_type: IndexType = "flat",
+    reuse_splits: bool = False,
+    verbose: bool = False,
+    cheap_model: str | None = None,
+    resume: bool = False,
 ):
     """
     LangChainを使って付加的情報を生成する
+    生成結果は 1件ごとに output_file (jsonl) に追記するので、途中で止まっても resume=True で再実行すれば続きから生成する
     """
+    if cheap_model is not None and retriever_type != "openai-embedding":
+        raise ValueError(f"cheap_model requires retriever_type='openai-embedding', got {retriever_type!r}")
+
+    if cache_path is not None:
+        setup_llm_cache(cache_path)
 
     def format_docs(docs):
         return "\n\n".join(doc.page_content for doc in docs)
 
     def log_documents(docs):
         for doc in docs:
-            logger.info(f"Document: {doc.page_content}")
+            logger.debug("Document: {}", doc.page_content)
         return docs
 
     def log_prompt(prompt: str) -> str:
-        logger.info(f"Overall Prompt: {prompt}")
+        logger.debug("Overall Prompt: {}", prompt)
         return prompt
 
-    retriever = get_retriever_langchain(retriever_type, langchain_store_dir=PERSIST_LANGCHAIN_DIR)
-
-    llm = LangChainOpenAI(
-        **MODEL_CONFIG
+    retriever = get_retriever_langchain(
+        retriever_type, 
+        langchain_store_dir=PERSIST_LANGCHAIN_DIR, 
+        index_type=index_type, 
+        reuse_splits=reuse_splits
     )
 
+    # 非同期側のクライアントは最初に使ったイベントループに紐づくため、モジュールで共有せず実行ごとに作る
+    # (invoke_chain の asyncio.run の中で使い、その中で閉じる)
+    http_client = httpx.Client(**HTTP_CLIENT_CONFIG)
+    http_async_client = httpx.AsyncClient(**HTTP_CLIENT_CONFIG)
+
+    def build_llm(model: str) -> Runnable:
+        llm = LangChainOpenAI(
+            **{**MODEL_CONFIG, "model": model},
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+        if semantic_cache_threshold is not None:
+            # 言い換えのプロンプトには過去の応答を再利用する (モデルごとに別ファイル)
+            # 全リクエスト共通の指示文は除いて埋め込む (指示文ごと埋め込んでいた以前のファイルとは分ける)
+            semantic_cache = SemanticCache(
+                OpenAIEmbeddings(**EMBEDDING_CONFIG),
+                cache_file=SEMANTIC_CACHE_DIR / f"{model}-{EMBEDDING_CONFIG['model']}-no-instruction.jsonl",
+                score_threshold=semantic_cache_threshold,
+                ignore_prefixes=(_PROMPT_PREFIX, _PROMPT_PREFIX_NO_RETRIEVAL),
+            )
+            llm = semantic_cache.wrap(llm)
+        return llm
+
+    llm = build_llm(MODEL_CONFIG["model"])
+
+    # プロンプト以降の共通部分 (ログ出力は verbose のときだけチェーンに入れる)
+    # prompt が None の場合は、レンダリング済みのプロンプト文字列を入力として受け取る
+    def build_generation_chain(prompt: PromptTemplate | None, llm: Runnable = llm) -> Runnable:
+        generation_chain = llm | StrOutputParser()
+        if verbose:
+            generation_chain = log_prompt | generation_chain
+        if prompt is not None:
+            generation_chain = prompt | generation_chain
+        return generation_chain
+
     # リファレンスドキュメントが与えられた場合使う
-    reference_doc_data = None
-    get_reference_documents_partial = None
+    reference_doc_index = None
 
     # チェーンの構築
+    # 入力の辞書は 1つの RunnableLambda でまとめて作る
     if no_retrieval:
+        def build_inputs(spotting_data):
+            return {"query": spotting_data.query}
+
         rag_chain = (
-            {
-                "instruction": lambda _: INSTRUCTION,  
-                "query": lambda spotting_data: spotting_data.query}
-            | PromptTemplate.from_template(prompt_template_no_retrieval)
-            | log_prompt
-            | llm
-            | StrOutputParser()
+            RunnableLambda(build_inputs)
+            | build_generation_chain(_PROMPT_NO_RETRIEVAL)
         )
     elif reference_documents_yaml is not None:
         # 正解文書の準備
+        # 文書は生成対象の抽出時に 1件につき 1回だけ引き、プロンプトもそこでレンダリングして渡す
         reference_doc_data = ReferenceDoc.get_list_from_yaml(reference_documents_yaml)
-        get_reference_documents_partial = partial(ReferenceDoc.get_reference_documents, reference_documents=reference_doc_data)
+        reference_doc_index = ReferenceDoc.build_index(reference_doc_data)
 
-        rag_chain = (
-            {
-                "instruction": lambda _: INSTRUCTION, 
-                "documents": lambda spotting_data: get_reference_documents_partial(spotting_data.game, spotting_data.half, spotting_data.game_time),
-                "query": lambda spotting_data: spotting_data.query}
-            | PromptTemplate.from_template(prompt_template)
-            | log_prompt
-            | llm
-            | StrOutputParser()
-        )
+        rag_chain = build_generation_chain(None)
     else:
-        def process_docs(spotting_data):
-            query = lambda _: spotting_data.query # noqa
-            docs = query | retriever | log_documents | format_docs
-            return docs
+        def to_inputs(spotting_data, docs, top_score=None):
+            if verbose:
+                log_documents(docs)
+            return {"documents": format_docs(docs), "query": spotting_data.query, "top_score": top_score}
+
+        # cheap_model を使う場合はルーティング用に関連度スコアも取る
+        def to_inputs_with_scores(spotting_data, docs_and_scores):
+            docs = [doc for doc, _ in docs_and_scores]
+            top_score = max((score for _, score in docs_and_scores), default=0.0)
+            return to_inputs(spotting_data, docs, top_score)
+
+        def build_inputs(spotting_data, config: RunnableConfig):
+            if cheap_model is not None:
+                docs_and_scores = retriever.vectorstore.similarity_search_with_relevance_scores(
+                    spotting_data.query, **SEARCH_CONFIG
+                )
+                return to_inputs_with_scores(spotting_data, docs_and_scores)
+            docs = retriever.invoke(spotting_data.query, config)
+            return to_inputs(spotting_data, docs)
+
+        async def abuild_inputs(spotting_data, config: RunnableConfig):
+            if cheap_model is not None:
+                docs_and_scores = await retriever.vectorstore.asimilarity_search_with_relevance_scores(
+                    spotting_data.query, **SEARCH_CONFIG
+                )
+                return to_inputs_with_scores(spotting_data, docs_and_scores)
+            docs = await retriever.ainvoke(spotting_data.query, config)
+            return to_inputs(spotting_data, docs)
+
+        generation_chain = build_generation_chain(_PROMPT)
+        if cheap_model is not None:
+            generation_chain = build_routed_chain(
+                cheap_chain=build_generation_chain(_PROMPT, build_llm(cheap_model)),
+                strong_chain=generation_chain,
+            )
+
         rag_chain = (
-            {
-                "instruction": lambda _: INSTRUCTION, 
-                "documents": lambda spotting_data: process_docs(spotting_data), 
-                "query": lambda spotting_data: spotting_data.query}
-            | PromptTemplate.from_template(prompt_template)
-            | log_prompt
-            | llm
-            | StrOutputParser()
+            RunnableLambda(build_inputs, afunc=abuild_inputs)
+            | generation_chain
+        )
+
+    # 生成済みのスポッティング (再開用)
+    output_path = Path(output_file)
+    if not resume and output_path.exists():
+        output_path.unlink()
+    # 同じキーのスポッティングが複数ある場合もあるので、書き出し済みの件数を数えておく
+    done_counts = Counter()
+    if output_path.exists():
+        trim_incomplete_last_line(output_path)
+        done_counts = Counter(
+            (s.game, s.half, s.game_time, s.query) 
+            for s in SpottingDataList.from_jsonline(output_file).spottings
         )
+        logger.info("Resume: {} spottings are already in {}", done_counts.total(), output_file)
+
+    def is_done(s) -> bool:
+        key = (s.game, s.half, s.game_time, s.query)
+        if done_counts[key] > 0:
+            done_counts[key] -= 1
+            return True
+        return False
+
+    # 生成対象の抽出
+    # クエリの有無は列単位でまとめて判定し、残った行だけをチェーンに渡す
+    spotting_df = spotting_data_list.to_dataframe()
+    mask = spotting_df["query"].notna().to_numpy()
+    target_spottings = [
+        s for s in (spotting_data_list.spottings[i] for i in np.flatnonzero(mask))
+        if not is_done(s)
+    ]
+    chain_inputs = target_spottings
+    if reference_doc_index is not None:
+        reference_spottings, chain_inputs = [], []
+        for spotting_data in target_spottings:
+            documents = ReferenceDoc.get_reference_documents(
+                spotting_data.game, spotting_data.half, spotting_data.game_time, reference_doc_index
+            )
+            if documents is None:
+                # 正解文書がない場合はスキップ
+                logger.info("skip : {}, {}, {}", spotting_data.game, spotting_data.half, spotting_data.game_time)
+                continue
+            reference_spottings.append(spotting_data)
+            chain_inputs.append(_PROMPT.format(documents=documents, query=spotting_data.query))
+        target_spottings = reference_spottings
 
     # run
-    result_list = SpottingDataList([])
-    for spotting_data in spotting_data_list.spottings:
-        logger.info(f"Query: {spotting_data.query}")
-        if spotting_data.query is None:
-            continue
-        
-        if reference_doc_data is not None and \
-            get_reference_documents_partial(spotting_data.game, spotting_data.half, spotting_data.game_time) is None:
-            # 正解文書がない場合はスキップ
-            logger.info(f"skip : {spotting_data.game}, {spotting_data.half}, {spotting_data.game_time}")
-            continue
-        
-        response = rag_chain.invoke(spotting_data)
-        spotting_data.generated_text = response
-        result_list.spottings.append(spotting_data)
-        
-        logger.info(f"Response: {response}")
-    # save
-    result_list.to_jsonline(output_file)
+    # 同じプロンプトになる入力は 1回だけ生成し、応答を元の位置に配る
+    # プロンプトは、参照文書モードではレンダリング済みの文字列、それ以外ではクエリだけで決まる
+    dedup_keys = [x if isinstance(x, str) else x.query for x in chain_inputs]
+    unique_inputs, inverse = deduplicate(chain_inputs, dedup_keys)
+    spottings_by_input = [[] for _ in unique_inputs]
+    for spotting_data, i in zip(target_spottings, inverse):
+        spottings_by_input[i].append(spotting_data)
+    logger.info("Generate {} unique prompts for {} spottings", len(unique_inputs), len(chain_inputs))
+
+    # 応答は完了順に返ってくるが、ファイルにはスポッティングの入力の順に書き出す
+    # 先頭から応答が揃っているスポッティングだけを書き出し、残りは応答が揃うまで待つ
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "ab") as f:
+        responses: dict[int, str] = {}
+        next_j = 0
+
+        def save_response(i: int, response: str):
+            nonlocal next_j
+            logger.info("Query: {}", spottings_by_input[i][0].query)
+            logger.info("Response: {}", response)
+
+            responses[i] = response
+            start_j = next_j
+            while next_j < len(target_spottings) and inverse[next_j] in responses:
+                spotting_data = target_spottings[next_j]
+                spotting_data.generated_text = responses[inverse[next_j]]
+                f.write(spotting_data.to_json_line())
+                next_j += 1
+            if next_j > start_j:
+                f.flush()
+
+        try:
+            invoke_chain(
+                rag_chain, unique_inputs, concurrency, stream, 
+                on_result=save_response, async_client=http_async_client
+            )
+        finally:
+            http_client.close()
+
+
+def trim_incomplete_last_line(path: Path):
+    """
+    途中で止まった実行が書きかけた最後の行 (改行で終わっていない行) を切り詰める
+    そのまま追記すると、壊れた行に次の行がつながってしまうため
+    """
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logger.warning("Drop an incomplete last line in {}: {!r}", path, data[end:end + 100])
+            f.truncate(end)
+
+
+def build_routed_chain(cheap_chain: Runnable, strong_chain: Runnable) -> Runnable:
+    """
+    最上位の文書の関連度スコア (inputs["top_score"]) が min_top_score 以上なら cheap_chain で生成し、
+    それ以外は strong_chain で生成する
+    cheap_chain の応答が「分からない」旨の場合は strong_chain でやり直す
+    """
+    def is_hedged(response: str) -> bool:
+        response = response.lower()
+        return any(marker in response for marker in ROUTING_CONFIG["hedge_markers"])
+
+    def cheap_then_strong(inputs: dict, config: RunnableConfig) -> str:
+        response = cheap_chain.invoke(inputs, config)
+        if is_hedged(response):
+            logger.info("Escalate to the strong model: {}", response)
+            return strong_chain.invoke(inputs, config)
+        return response
+
+    async def acheap_then_strong(inputs: dict, config: RunnableConfig) -> str:
+        response = await cheap_chain.ainvoke(inputs, config)
+        if is_hedged(response):
+            logger.info("Escalate to the strong model: {}", response)
+            return await strong_chain.ainvoke(inputs, config)
+        return response
+
+    return RunnableBranch(
+        (
+            lambda inputs: inputs["top_score"] >= ROUTING_CONFIG["min_top_score"],
+            RunnableLambda(cheap_then_strong, afunc=acheap_then_strong),
+        ),
+        strong_chain,
+    )
+
+
+def setup_llm_cache(cache_path: str):
+    """
+    LLM の応答キャッシュをグローバルに設定する
+    キャッシュキーはレンダリング後のプロンプトとモデル設定のハッシュなので、
+    プロンプトテンプレートを変更すると自動的に別エントリになる
+    複数プロセスで共有する場合は redis:// の URL を渡す
+    """
+    if cache_path.startswith("redis://"):
+        import redis
+        from langchain_community.cache import RedisCache
+
+        set_llm_cache(RedisCache(redis.Redis.from_url(cache_path)))
+    else:
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        set_llm_cache(SQLiteCache(database_path=cache_path))
+
+
+def deduplicate(items: list, keys: list) -> tuple[list, list[int]]:
+    """
+    keys が同じ要素をまとめ、(重複を除いた要素のリスト, 各要素が対応する位置のリスト) を返す
+    重複を除いた要素は最初に現れた順に並ぶ
+    """
+    positions = {}
+    unique_items, inverse = [], []
+    for item, key in zip(items, keys):
+        if key not in positions:
+            positions[key] = len(unique_items)
+            unique_items.append(item)
+        inverse.append(positions[key])
+    return unique_items, inverse
+
+
+def invoke_chain(
+    rag_chain: Runnable, 
+    inputs: list, 
+    concurrency: int = 16, 
+    stream: bool = False,
+    on_result: Callable[[int, str], None] | None = None,
+    async_client: httpx.AsyncClient | None = None
+) -> list[str]:
+    """
+    inputs の各要素に対してチェーンを実行し、入力と同じ順序で応答を返す
+    concurrency > 1 の場合は最大 concurrency 件のリクエストを並行して投げる
+    stream の場合は生成途中の応答を標準出力に書き出す
+    on_result が与えられた場合は、応答が返ってくるたびに (入力の位置, 応答) で呼ぶ
+    async_client が与えられた場合は、チェーンが使う非同期クライアントとしてイベントループの中で閉じる
+    """
+    # レートリミットに当たった場合は指数バックオフで再試行する
+    rag_chain = rag_chain.with_retry(
+        retry_if_exception_type=(RateLimitError,),
+        **RETRY_CONFIG
+    )
+    on_result = on_result or (lambda i, response: None)
+
+    if concurrency <= 1 and not stream:
+        # デバッグ用の逐次実行
+        responses = []
+        for i, x in enumerate(inputs):
+            responses.append(rag_chain.invoke(x))
+            on_result(i, responses[-1])
+        return responses
+
+    return asyncio.run(_arun_all(rag_chain, inputs, concurrency, stream, on_result, async_client))
+
+
+async def _arun_all(
+    rag_chain: Runnable, 
+    inputs: list, 
+    concurrency: int, 
+    stream: bool,
+    on_result: Callable[[int, str], None],
+    async_client: httpx.AsyncClient | None = None
+) -> list[str]:
+    """
+    セマフォで同時実行数を concurrency 件に制限しながら各入力を実行し、入力と同じ順序で応答を返す
+    (abatch_as_completed は with_retry の再試行を通らないため ainvoke を直接使う)
+    stream の場合、concurrency == 1 ならトークンを届いた順に、
+    それ以上なら複数の応答が混ざらないよう完成した応答から順に標準出力へ書き出す
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def _astream(x) -> str:
+        chunks = []
+        async for chunk in rag_chain.astream(x):
+            chunks.append(chunk)
+            if concurrency <= 1:
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+        response = "".join(chunks)
+        print("" if concurrency <= 1 else response, flush=True)
+        return response
+
+    async def _arun(i: int, x) -> str:
+        async with semaphore:
+            response = await (_astream(x) if stream else rag_chain.ainvoke(x))
+        on_result(i, response)
+        return response
+
+    # 接続はこのイベントループに紐づくので、ループが閉じる前にクライアントを閉じる
+    async with async_client or contextlib.nullcontext():
+        return await asyncio.gather(*(_arun(i, x) for i, x in enumerate(inputs)))
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class PrunedBM25Retriever(BM25Retriever):
+    """
+    クエリ中の語を IDF の上位 max_query_terms 語に絞ってからスコアを計算する BM25Retriever
+    IDF の低い語 (ストップワードなど) はスコアにほとんど寄与しないため、
+    結果を大きく変えずにクエリあたりの計算量を語数に比例して削減できる
+    """
+    max_query_terms: int = BM25_MAX_QUERY_TERMS
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        query_tokens = self.preprocess_func(query)
+        idf = self.vectorizer.idf
+        kept_terms = set(sorted(set(query_tokens), key=lambda t: idf.get(t, 0.0), reverse=True)[:self.max_query_terms])
+        query_tokens = [t for t in query_tokens if t in kept_terms]
+        return self.vectorizer.get_top_n(query_tokens, self.docs, n=self.k)
 
 
 def get_retriever_langchain(
     type: RetrieverType, 
-    langchain_store_dir: Path
+    langchain_store_dir: Path,
+    index_type: IndexType = "flat",
+    reuse_splits: bool = False
 ) -> BaseRetriever:
+    load_splits = get_document_splits_cached if reuse_splits else get_document_splits
     if type == "tfidf":
         if not os.path.exists(langchain_store_dir):
             # インデックスの構築
-            splits = get_document_splits(DOCUMENT_DIR)
+            splits = load_splits(DOCUMENT_DIR)
             retriever = TFIDFRetriever.from_documents(splits)
             # 保存
             retriever.save_local(folder_path=langchain_store_dir)
@@ -208,17 +612,27 @@ def get_retriever_langchain(
             )
         retriever.k = SEARCH_CONFIG["k"]
         return retriever
+    elif type == "bm25":
+        # BM25 はインデックスの構築が軽いので保存せず毎回作る
+        splits = load_splits(DOCUMENT_DIR)
+        retriever = PrunedBM25Retriever.from_documents(
+            splits,
+            preprocess_func=tokenize,
+            k=SEARCH_CONFIG["k"],
+        )
+        return retriever
     elif type == "openai-embedding":
         embeddings = OpenAIEmbeddings(**EMBEDDING_CONFIG)
+        if index_type != "flat":
+            # インデックスの種類ごとに保存場所を分ける
+            # ivfpq は並べ直し (IndexRefineFlat) を入れる前のインデックスを読まないよう別の場所にする
+            store_suffix = "ivfpq-refine" if index_type == "ivfpq" else index_type
+            langchain_store_dir = Path(langchain_store_dir)
+            langchain_store_dir = langchain_store_dir.with_name(f"{langchain_store_dir.name}-{store_suffix}")
         if not os.path.exists(langchain_store_dir):
             # インデックスの構築
-            splits = get_document_splits(DOCUMENT_DIR)
-            
-            vectorstore = FAISS.from_documents(documents=splits, embedding=embeddings)
-            retriever = vectorstore.as_retriever(
-                search_type="similarity_score_threshold",
-                search_kwargs={'score_threshold': EMBEDDING_CONFIG["score_threshold"], 'k': EMBEDDING_CONFIG["k"]}
-            )
+            splits = load_splits(DOCUMENT_DIR)
+            vectorstore = build_faiss_vectorstore(splits, embeddings, index_type)
             # 保存
             vectorstore.save_local(folder_path=langchain_store_dir)
         else:
@@ -228,38 +642,170 @@ def get_retriever_langchain(
                 embeddings=embeddings,
                 allow_dangerous_deserialization=True
             )
-            retriever = vectorstore.as_retriever(
-                search_type="similarity_score_threshold",
-                search_kwargs=SEARCH_CONFIG
-            )
+        set_faiss_search_params(vectorstore.index)
+        retriever = vectorstore.as_retriever(
+            search_type="similarity_score_threshold",
+            search_kwargs=SEARCH_CONFIG
+        )
         return retriever
     else:
-        raise ValueError(f"Invalid retriever type: {type}. Use 'tfidf' or 'openai-embedding'.")
+        raise ValueError(f"Invalid retriever type: {type}. Use 'tfidf', 'bm25' or 'openai-embedding'.")
+
+
+def build_faiss_vectorstore(
+    splits: list[Document], 
+    embeddings: OpenAIEmbeddings, 
+    index_type: IndexType = "flat"
+) -> FAISS:
+    """
+    flat: 全件との距離を計算する (FAISS のデフォルト)
+    hnsw: グラフベースの近似近傍探索
+    ivfpq: 転置ファイル + 直積量子化で候補を絞り、元のベクトルとの距離で並べ直す近似近傍探索
+    """
+    texts = [doc.page_content for doc in splits]
+    vectors = embed_texts(embeddings, texts)
+    index = build_faiss_index(vectors, index_type)
+
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+    vectorstore.add_embeddings(
+        zip(texts, vectors.tolist()),
+        metadatas=[doc.metadata for doc in splits],
+    )
+    return vectorstore
+
+
+def embed_texts(embeddings: OpenAIEmbeddings, texts: list[str]) -> np.ndarray:
+    """
+    texts を chunk_size 件ずつに分け、最大 EMBEDDING_CONCURRENCY 件のリクエストを並行して埋め込む
+    """
+    chunk_size = embeddings.chunk_size
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+    async def _aembed_all():
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+        async def _aembed(chunk: list[str]) -> list[list[float]]:
+            async with semaphore:
+                return await embeddings.aembed_documents(chunk)
+
+        return await asyncio.gather(*(_aembed(chunk) for chunk in chunks))
+
+    vectors = [vector for chunk_vectors in asyncio.run(_aembed_all()) for vector in chunk_vectors]
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: IndexType) -> faiss.Index:
+    """
+    学習済み (まだ追加はしていない) のインデックスを返す
+    どれも返す距離は正確な L2 なので、スコアの閾値はそのまま使える
+    (ivfpq は PQ の近似距離のままだと関連度スコアがずれるため、IndexRefineFlat で並べ直す)
+    """
+    num_vectors, dim = vectors.shape
+
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+
+    if index_type == "ivfpq":
+        # PQ の各部分空間で 2**nbits 個のセントロイドを学習するので、その 39 倍の学習データが必要
+        min_vectors = FAISS_MIN_POINTS_PER_CENTROID * 2 ** IVFPQ_CONFIG["nbits"]
+        if num_vectors >= min_vectors:
+            # クラスタあたり 39 件以上の学習データを確保する
+            nlist = max(1, min(IVFPQ_CONFIG["nlist"], num_vectors // FAISS_MIN_POINTS_PER_CENTROID))
+            quantizer = faiss.IndexFlatL2(dim)
+            ivfpq = faiss.IndexIVFPQ(quantizer, dim, nlist, IVFPQ_CONFIG["m"], IVFPQ_CONFIG["nbits"])
+            index = faiss.IndexRefineFlat(ivfpq)
+            index.k_factor = IVFPQ_CONFIG["k_factor"]
+            index.train(vectors)
+            return index
+        logger.warning(
+            "Too few vectors ({} < {}) to train IVFPQ. Use HNSW instead.", num_vectors, min_vectors
+        )
 
+    index = faiss.IndexHNSWFlat(dim, HNSW_CONFIG["M"])
+    index.hnsw.efConstruction = HNSW_CONFIG["ef_construction"]
+    return index
 
-def get_document_splits(ducument_dir: Path, chunk_size: int = 1000, chunk_overlap: int = 100):
+
+def set_faiss_search_params(index: faiss.Index):
+    if isinstance(index, faiss.IndexRefine):
+        # 読み込み直したインデックスでは k_factor と内側のインデックスの型を戻す
+        index.k_factor = IVFPQ_CONFIG["k_factor"]
+        index = faiss.downcast_index(index.base_index)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_CONFIG["ef_search"]
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVFPQ_CONFIG["nprobe"]
+
+
+def get_document_splits(ducument_dir: Path, chunk_size: int = 1000, chunk_overlap: int = 100, max_workers: int = 16):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    documents = []
-    for doc_path in os.listdir(ducument_dir):
-        with open(os.path.join(ducument_dir, doc_path), "r") as f:
-            doc = Document(page_content=f.read())
-            documents.append(doc)
+    doc_paths = [Path(ducument_dir) / doc_path for doc_path in os.listdir(ducument_dir)]
+    # ファイル読み込みは I/O 待ちが主なのでスレッドで並列化する (順序は保たれる)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        texts = list(executor.map(Path.read_text, doc_paths))
+    documents = [Document(page_content=text) for text in texts]
     splits = text_splitter.split_documents(documents)
     return splits
 
 
+def get_document_splits_cached(
+    ducument_dir: Path, 
+    chunk_size: int = 1000, 
+    chunk_overlap: int = 100, 
+    cache_dir: Path = SPLITS_CACHE_DIR
+):
+    """
+    get_document_splits の結果を pickle で保存し、次回以降はそれを読み込む
+    キャッシュキーは各ファイルの (パス, 更新時刻, サイズ) と分割の設定のハッシュなので、
+    知識ベースか設定が変われば自動的に作り直される
+    """
+    doc_stats = []
+    for doc_path in os.listdir(ducument_dir):
+        stat = os.stat(os.path.join(ducument_dir, doc_path))
+        doc_stats.append((doc_path, stat.st_mtime_ns, stat.st_size))
+    key_source = repr((sorted(doc_stats), chunk_size, chunk_overlap))
+    key = hashlib.sha256(key_source.encode()).hexdigest()
+    cache_path = Path(cache_dir) / f"splits-{key}.pkl"
+
+    if cache_path.exists():
+        logger.info("Load document splits from {}", cache_path)
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+
+    splits = get_document_splits(ducument_dir, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, "wb") as f:
+        pickle.dump(splits, f)
+    return splits
+
+
 if __name__ == "__main__":
     args = Arguments().parse_args()
 
-    spotting_data_list = SpottingDataList.from_jsonline(args.input_file)
+    # ログの出力はバックグラウンドのスレッドに任せる
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.verbose else "INFO", enqueue=True)
 
-    if args.no_retrieval:
-        INSTRUCTION = INSTRUCTION.replace("Using the documents below,", "")
+    spotting_data_list = SpottingDataList.from_jsonline(args.input_file)
 
     run_langchain(
         spotting_data_list, 
         args.output_file, 
         args.retriever_type, 
         args.no_retrieval, 
-        args.reference_documents_yaml
+        args.reference_documents_yaml,
+        args.concurrency,
+        None if args.no_cache else args.cache_path,
+        args.semantic_cache_threshold,
+        args.stream,
+        args.index_type,
+        args.reuse_splits,
+        args.verbose,
+        args.cheap_model,
+        args.resume,
     )
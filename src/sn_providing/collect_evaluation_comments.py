@@ -19,6 +19,7 @@ class Arguments(Tap):
 
 def main(args: Arguments):
     reference_doc_list = ReferenceDoc.get_list_from_yaml(args.reference_documents_yaml)
+    reference_doc_index = ReferenceDoc.build_index(reference_doc_list)
     
     input_a_data_list = SpottingDataList.from_jsonline(args.input_a_file)
     input_b_data_list = SpottingDataList.from_jsonline(args.input_b_file)
@@ -44,7 +45,7 @@ def main(args: Arguments):
                 game=spotting_data.game,
                 half=spotting_data.half,
                 time=spotting_data.game_time,
-                reference_documents=reference_doc_list,
+                reference_index=reference_doc_index,
             )
             if reference_doc is not None:
                 sample_id = reference_doc.id
@@ -1,6 +1,9 @@
 from tap import Tap
 from loguru import logger
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 from sn_providing.entity import CommentDataList, SpottingDataList, VideoData
 
@@ -17,6 +20,8 @@ class Arguments(Tap):
     
     sec_window_player: int = 2
     sec_window_action: int = 15
+    
+    n_jobs: int = 1 # クエリの組み立てに使うプロセス数 (1 の場合はメインプロセスで逐次実行)
 
 
 def build_query(
@@ -31,39 +36,47 @@ def build_query(
     - TODO Game State Reconstruction の情報
     - TODO OSL Spotiing のAction Spotting の情報
     """
-    query = []
-    total_length = 0
+    # commentsは時系列順に並んでいるので、直近のコメントから max_length 文字に収まるだけ取得
+    # 直近から数えた (文字数 + 区切りの空白) の累積和が max_length + 1 以下のものまで入る
+    texts = [c.text for c in comments.comments]
+    lengths = np.fromiter((len(t) + 1 for t in reversed(texts)), dtype=np.int64, count=len(texts))
+    num_comments = int(np.searchsorted(np.cumsum(lengths), max_length + 1, side="right"))
+    # 各行を上から順に並べて最後に 1 回だけ連結する
+    lines = []
     
-    # commentsは時系列順に並んでいるので、逆順にして直近のコメントから取得
-    for comment in reversed(comments.comments):
-        if total_length + len(comment.text) > max_length:
-            break
-        query.append(comment.text)
-        total_length += len(comment.text) + 1
+    # アクション情報を取得
+    if actions := kwargs.get("actions"):
+        action_str = ", ".join(actions) #たいていは高々一つのはず
+        lines.append(f"Recent Event: {action_str}")
     
-    # 逆順にしていたので、再度逆順にして返す
-    query = " ".join(reversed(query))
-    query = "Previous comments: " + query
+    # 試合情報を取得
+    if game_data := kwargs.get("game_metadata"):
+        lines.append(f"Game: {game_data['league']} {game_data['league']} {game_data['date']} {game_data['home_team']} vs {game_data['away_team']}")
     
     # 映像中に映っている選手の名前を取得
-    if kwargs.get("players"):
-        team_game_str = ", ".join([f"{p['name']} from {p['team']}" for p in kwargs['players']])
-        query = f"Players shown in this frame: {team_game_str}\n" + query
-
-    # 試合情報を取得
-    if kwargs.get("game_metadata"):
-        game_data = kwargs["game_metadata"]
-        game_query = f"Game: {game_data['league']} {game_data['league']} {game_data['date']} {game_data['home_team']} vs {game_data['away_team']}"
-        query = game_query + "\n" + query
+    if players := kwargs.get("players"):
+        team_game_str = _format_players(tuple((p["name"], p["team"]) for p in players))
+        lines.append(f"Players shown in this frame: {team_game_str}")
     
-    # アクション情報を取得
-    if actions := kwargs.get("actions"):
-        action_str = ", ".join(actions) #たいていは高々一つのはず
-        query = f"Recent Event: {action_str}\n" + query
+    lines.append(f"Previous comments: {' '.join(texts[len(texts) - num_comments:])}")
+    query = "\n".join(lines)
 
     return query
 
 
+@lru_cache(maxsize=4096)
+def _format_players(name_team_pairs: tuple[tuple[str, str], ...]) -> str:
+    """
+    近いスポッティングは同じ選手の組になることが多いので、(name, team) の組ごとに文字列をキャッシュする
+    """
+    return ", ".join(f"{name} from {team}" for name, team in name_team_pairs)
+
+
+def _build_query_from_args(query_args: dict) -> str:
+    # ProcessPoolExecutor に渡すため、モジュールレベルの関数にしておく
+    return build_query(**query_args)
+
+
 def run(args: Arguments):
     # input_file includes json: {"UrlLocal": "path", "predictions", [{"gameTime": "1 - 00:24", "category": 0 or 1}, {...}, ...]}
     """
@@ -75,7 +88,7 @@ def run(args: Arguments):
     3. construct query
     """
     logger.info("Start constructing query")
-    logger.info(f"{args=}")
+    logger.info("args={}", args)
     
     spotting_data_list = SpottingDataList.read_csv(args.input_file)    
     spotting_data_list.filter_by_category_1()
@@ -85,39 +98,49 @@ def run(args: Arguments):
     comment_data_list = CommentDataList.read_csv(args.comment_csv, args.game)
     
     logger.info("Spotting data")
-    logger.info(f"{len(spotting_data_list.spottings)=}")
+    logger.info("len(spotting_data_list.spottings)={}", len(spotting_data_list.spottings))
     logger.info("Comment data")
-    logger.info(f"{len(comment_data_list.comments)=}")
+    logger.info("len(comment_data_list.comments)={}", len(comment_data_list.comments))
     logger.info("Game data")
-    logger.info(f"{spotting_data_list.game_metadata=}")
+    logger.info("spotting_data_list.game_metadata={}", spotting_data_list.game_metadata)
     
     result_spottings = []
     
-    # spotting データのtimeリスト と video_data の timeリスト を比較する
-    spot_time_set = set()
-    for spotting_data in spotting_data_list.spottings:
-        spot_time_set.add((spotting_data.half, spotting_data.game_time))
-    
+    # 各スポッティングの直前のコメントをまとめて取得
+    filtered_comment_lists = comment_data_list.filter_by_half_and_time_all(
+        [s.half for s in spotting_data_list.spottings],
+        [s.game_time for s in spotting_data_list.spottings]
+    )
+    # 各スポッティング周辺の選手とアクションをまとめて取得
+    video_data_dicts = [None] * len(spotting_data_list.spottings)
     if video_data is not None:
-        frame_time_set = set()
-        for i, data in video_data.player_df.iterrows():
-            frame_time_set.add((data["half"], data["time"]))
-
-    for spotting_data in spotting_data_list.spottings:
-        filtered_comment_list = CommentDataList.filter_by_half_and_time(
-            comment_data_list, 
-            spotting_data.half, 
-            spotting_data.game_time
+        video_data_dicts = video_data.get_data_all(
+            args.game,
+            [s.half for s in spotting_data_list.spottings],
+            [s.game_time for s in spotting_data_list.spottings]
         )
-        
+    
+    query_args_list = []
+    for filtered_comment_list, video_data_dict in zip(filtered_comment_lists, video_data_dicts):
         query_args = {"comments": filtered_comment_list, "video_data": None, "game_metadata": spotting_data_list.game_metadata}
         
-        if video_data is not None:
-            video_data_dict = video_data.get_data(args.game, spotting_data.half, spotting_data.game_time)
+        if video_data_dict is not None:
             query_args["players"] = video_data_dict["players"]
             query_args["actions"] = video_data_dict["actions"]
-        
-        query = build_query(**query_args)
+        query_args_list.append(query_args)
+    
+    # スポッティングごとに独立しているので、n_jobs > 1 の場合はプロセスに分けて組み立てる
+    if args.n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.n_jobs) as executor:
+            queries = list(executor.map(
+                _build_query_from_args, 
+                query_args_list, 
+                chunksize=max(1, len(query_args_list) // (args.n_jobs * 4))
+            ))
+    else:
+        queries = [_build_query_from_args(query_args) for query_args in query_args_list]
+    
+    for spotting_data, query in zip(spotting_data_list.spottings, queries):
         spotting_data.query = query
         
         # reference があれば追加
@@ -132,7 +155,7 @@ def run(args: Arguments):
     elif args.output_file.endswith(".jsonl"):
         spotting_data_list.to_jsonline(args.output_file)
     
-    logger.info(f"Output file is saved at {args.output_file}")
+    logger.info("Output file is saved at {}", args.output_file)
 
 if __name__ == "__main__":
     ### construct query from the input file
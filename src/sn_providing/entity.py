@@ -1,15 +1,29 @@
 from pathlib import Path
+import os
 import re
 from typing import Dict, Optional, List
-import json
+import orjson
+import numpy as np
 import pandas as pd
-from dataclasses import dataclass
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from dataclasses import dataclass, asdict, field, fields
 from loguru import logger
 import yaml
 from typing import Literal
 
 
-@dataclass
+# to_jsonline で 1 回の write にまとめる行数
+JSONL_WRITE_BATCH_SIZE = 8192
+
+
+def _advise_sequential(f):
+    """先頭から末尾まで読むファイルであることをカーネルに伝え、先読みを増やしてもらう (Linux のみ)"""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+@dataclass(slots=True)
 class SpottingData:
     half: int
     game_time: int
@@ -22,6 +36,10 @@ class SpottingData:
     reference_text: Optional[str] = None
     sample_id: Optional[str] = None
 
+    def to_json_line(self) -> bytes:
+        # orjson は dataclass (slots 含む) をフィールド順の object として直接書き出せる
+        return orjson.dumps(self) + b"\n"
+
 
 @dataclass
 class SpottingDataList:
@@ -31,48 +49,65 @@ class SpottingDataList:
     
     @classmethod
     def read_csv(cls, json_file: str) -> "SpottingDataList":
-        data = json.load(open(json_file))
+        with open(json_file, "rb") as f:
+            _advise_sequential(f)
+            data = orjson.loads(f.read())
 
         spottings = []
-        for d in data["predictions"]:
-            minutes, seconds = map(int, d["gameTime"].split(" ")[-1].split(":"))
-            spotting = SpottingData(
-                half=int(d["half"]),
-                game_time=minutes * 60 + seconds,
-                confidence=float(d["confidence"]),
-                position=int(d["position"]),
-                category=str(d["category"])
-            )
-            spottings.append(spotting)
+        if data["predictions"]:
+            # 列ごとにまとめて型変換してから SpottingData を作る
+            preds = pd.DataFrame(data["predictions"])
+            # gameTime は "1 - 12:34" の形式
+            mm_ss = preds["gameTime"].str.extract(r"(\d+):(\d+)$").astype(np.int32)
+            game_times = (mm_ss[0] * 60 + mm_ss[1]).tolist()
+            halves = preds["half"].astype(np.int32).tolist()
+            confidences = preds["confidence"].astype(np.float64).tolist()
+            positions = preds["position"].astype(np.int64).tolist()
+            categories = preds["category"].astype(str).tolist()
+            spottings = [
+                SpottingData(half=half, game_time=game_time, confidence=confidence, position=position, category=category)
+                for half, game_time, confidence, position, category 
+                in zip(halves, game_times, confidences, positions, categories)
+            ]
 
         game_metadata = SpottingDataList.extract_data_from_game(data["game"])
         
         return cls(spottings, game_metadata)
     
+    def to_dataframe(self) -> pd.DataFrame:
+        """列ごとにまとめた DataFrame に変換する (行の順序は spottings と同じ)"""
+        return pd.DataFrame(
+            [asdict(s) for s in self.spottings], 
+            columns=[f.name for f in fields(SpottingData)]
+        )
+
     def filter_by_category_1(self):
         self.spottings = [s for s in self.spottings if s.category == "1"]
 
     @classmethod
     def from_jsonline(cls, input_file: str):
         spottings = []
-        with open(input_file) as f:
+        with open(input_file, "rb") as f:
+            _advise_sequential(f)
             for line in f:
-                spottings.append(SpottingData(**json.loads(line)))
+                spottings.append(SpottingData(**orjson.loads(line)))
         return cls(spottings)
 
     def to_json(self, output_file: str):
-        json.dump([s.__dict__ for s in self.spottings], open(output_file, "w"), ensure_ascii=False)    
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(self.spottings))
     
     def to_jsonline(self, output_file: str):
         Path(output_file).parent.mkdir(parents=True, exist_ok=True)
-        with open(output_file, 'w') as f:
-            for s in self.spottings:
-                f.write(json.dumps(s.__dict__, ensure_ascii=False) + "\n")
+        # JSONL_WRITE_BATCH_SIZE 行ずつまとめて 1 回で書き込む
+        with open(output_file, "wb") as f:
+            for i in range(0, len(self.spottings), JSONL_WRITE_BATCH_SIZE):
+                f.write(b"".join(s.to_json_line() for s in self.spottings[i:i + JSONL_WRITE_BATCH_SIZE]))
     
     def show_times(self, head: Optional[int] = None):
         head = head if head else len(self.spottings)
         for s in self.spottings[:head]:
-            logger.info(f"{s.half=}, {s.game_time=}")
+            logger.info("s.half={}, s.game_time={}", s.half, s.game_time)
 
     @staticmethod
     def extract_data_from_game(game: str):
@@ -102,7 +137,7 @@ class SpottingDataList:
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class CommentData:
     half: int
     start_time: int
@@ -113,33 +148,66 @@ class CommentData:
 @dataclass
 class CommentDataList:
     comments: List[CommentData]
+    # half -> (start_time の配列, コメントの配列) 。half ごとに start_time 順に並んでいる前提で read_csv が作る
+    _by_half: Dict[int, tuple[np.ndarray, List[CommentData]]] = field(default=None, repr=False, compare=False)
+    # comments を列ごとに持ったもの (filter_by_half_and_time で使う) 。与えられなければ __post_init__ で作る
+    _halves: np.ndarray = field(default=None, repr=False, compare=False)
+    _starts: np.ndarray = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self._halves is None or self._starts is None:
+            self._halves = np.fromiter((c.half for c in self.comments), dtype=np.int32, count=len(self.comments))
+            self._starts = np.fromiter((c.start_time for c in self.comments), dtype=np.int32, count=len(self.comments))
     
     @staticmethod
     def read_csv(comment_csv: str, game: str) -> "CommentDataList":
-        comment_df = pd.read_csv(comment_csv)
-        assert set(comment_df.columns) >= {"game", "half", "start", "end", "text", "付加的情報か"}
+        # 使う列だけを読む (列がない場合は read_csv が ValueError を出す)
+        # start は "MM:SS" 形式の場合もあるので型を指定しない
+        comment_df = pd.read_csv(
+            comment_csv,
+            usecols=["game", "half", "start", "text", "付加的情報か"],
+            dtype={"game": "category", "half": "int32", "付加的情報か": str}
+        )
         
         # TODO 前処理はmethod分割したい
         
-        def convert_time(time: str) -> int:
-            minute, second = map(int, time.split(":"))
-            return minute * 60 + second
-        
         # 指定のgame に対応するコメントのみ取得
         comment_df = comment_df[comment_df["game"] == game]
 
         # start time を秒に変換
-        if comment_df["start"].dtype == "O":
-            comment_df["start"] = comment_df["start"].apply(convert_time)
+        if comment_df["start"].dtype == "O" and len(comment_df) > 0:
+            minute_second = comment_df["start"].str.split(":", n=1, expand=True).astype(np.int32)
+            comment_df["start"] = minute_second[0] * 60 + minute_second[1]
         
-        # 並び替え
-        comment_df = comment_df.sort_values("start")
-        comments = []
-        for i, row in comment_df.iterrows():
-            comment = CommentData(int(row["half"]), int(row["start"]), row["text"], str(row["付加的情報か"]))
-            comments.append(comment)
+        # half ごとに start 順に並べる (同じ時刻のコメントは CSV の順序のまま)
+        # コメントを使う側は half ごとにしか時刻を比べないので、half をまたいだ時刻順にはしない
+        comment_df = comment_df.sort_values(["half", "start"], kind="mergesort")
+        # 列ごとに取り出してから CommentData を作る
+        halves = comment_df["half"].to_numpy(dtype=np.int32)
+        starts = comment_df["start"].to_numpy(dtype=np.int32)
+        texts = comment_df["text"].tolist()
+        categories = comment_df["付加的情報か"].astype(str).tolist()
+        comments = [
+            CommentData(half, start, text, category) 
+            for half, start, text, category in zip(halves.tolist(), starts.tolist(), texts, categories)
+        ]
         
-        return CommentDataList(comments)
+        comment_data_list = CommentDataList(comments, _halves=halves, _starts=starts)
+        comment_data_list._build_half_index()
+        return comment_data_list
+
+    def _build_half_index(self):
+        """
+        half ごとに start_time の配列とコメントを分けて持つ
+        comments は half ごとに start_time 順に並んでいる必要がある
+        """
+        by_half: Dict[int, List[CommentData]] = {}
+        for c in self.comments:
+            by_half.setdefault(c.half, []).append(c)
+        self._by_half = {
+            half: (np.asarray([c.start_time for c in half_comments], dtype=np.int32), half_comments)
+            for half, half_comments in by_half.items()
+        }
 
     @staticmethod
     def filter_by_half_and_time(
@@ -151,13 +219,38 @@ class CommentDataList:
         """
         seconds_before 秒前から game_time までのコメントを取得
         """
-        filterd_comments = [
-            c for c in comments.comments
-            if c.half == half and \
-                c.start_time >= game_time - seconds_before and \
-                c.start_time < game_time
-            ]
-        return CommentDataList(filterd_comments)
+        halves, starts = comments._halves, comments._starts
+        mask = (halves == half) & (starts >= game_time - seconds_before) & (starts < game_time)
+        return CommentDataList([comments.comments[i] for i in np.flatnonzero(mask)])
+
+    def filter_by_half_and_time_all(
+        self,
+        halves: List[int],
+        game_times: List[int],
+        seconds_before: int = 20
+    ) -> List["CommentDataList"]:
+        """
+        (halves[i], game_times[i]) ごとに filter_by_half_and_time と同じ結果を返す (comments は half ごとに start_time 順の前提)
+        half ごとに時刻順に並べたスポッティングとコメントを 2 つのポインタで 1 回だけ走査する
+        """
+        if self._by_half is None:
+            self._build_half_index()
+        results: List[CommentDataList] = [None] * len(halves)
+        order = sorted(range(len(halves)), key=lambda i: (halves[i], game_times[i]))
+        current_half, lo, hi = None, 0, 0
+        starts, half_comments = [], []
+        for i in order:
+            half, game_time = halves[i], game_times[i]
+            if half != current_half:
+                current_half, lo, hi = half, 0, 0
+                starts, half_comments = self._by_half.get(half, (np.empty(0, dtype=np.int32), []))
+                starts = starts.tolist()
+            while hi < len(starts) and starts[hi] < game_time:
+                hi += 1
+            while lo < hi and starts[lo] < game_time - seconds_before:
+                lo += 1
+            results[i] = CommentDataList(half_comments[lo:hi])
+        return results
     
     def get_comment_by_time(self, game_time: int) -> str:
         for comment in self.comments:
@@ -168,7 +261,7 @@ class CommentDataList:
     def show_times(self, head: Optional[int] = None):
         head = head if head else len(self.comments)
         for s in self.comments[:head]:
-            logger.info(f"{s.half=}, {s.start_time=}")
+            logger.info("s.half={}, s.start_time={}", s.half, s.start_time)
 
 
 class VideoData:
@@ -184,52 +277,121 @@ class VideoData:
         self.sec_window = sec_window_action
         
         # データを読み込み
-        self.player_df = pd.read_csv(player_csv)
-        assert {"game", "half", "time", "team", "name", "jersey_number"}.issubset(set(self.player_df.columns))
+        # 一番大きいファイルなので pyarrow のマルチスレッドの CSV リーダで読む
+        # 文字列の列は dictionary 型で読み、pandas では category になる
+        self.player_df = pacsv.read_csv(
+            player_csv,
+            convert_options=pacsv.ConvertOptions(
+                include_columns=["game", "half", "time", "team", "name", "jersey_number"],
+                column_types={
+                    "game": pa.dictionary(pa.int32(), pa.string()),
+                    "half": pa.int32(),
+                    "team": pa.dictionary(pa.int32(), pa.string()),
+                    "name": pa.dictionary(pa.int32(), pa.string()),
+                },
+                # pd.read_csv と同じく空のセルは欠損値にする
+                strings_can_be_null=True,
+            ),
+        ).to_pandas()
+        # (game, half, time) で引けるようにしておく
+        # 元の行の順序は row 列に残し、取得時にその順に戻す
+        self.player_df = (
+            self.player_df
+            .assign(
+                time=lambda df: pd.to_numeric(df["time"], downcast="integer"),
+                jersey_number=lambda df: pd.to_numeric(df["jersey_number"], downcast="integer"),
+            )
+            .rename_axis("row").reset_index()
+            .astype({"row": "int32"})
+            .set_index(["game", "half", "time"])
+            .sort_index()
+        )
+        # time が整数秒の場合は (game, half, time) -> [(row, 選手の record), ...] の辞書も作り、
+        # get_data では窓内の各秒を引くだけにする
+        self._player_index = None
+        if pd.api.types.is_integer_dtype(self.player_df.index.get_level_values("time")):
+            self._player_index = {}
+            keys = zip(*(self.player_df.index.get_level_values(level).tolist() for level in ("game", "half", "time")))
+            records = self.player_df[["name", "team", "jersey_number"]].to_dict(orient="records")
+            for key, row, record in zip(keys, self.player_df["row"].tolist(), records):
+                self._player_index.setdefault(key, []).append((row, record))
         
         self.spotting_df = None
         if spotting_csv is not None:
-            self.spotting_df = self._preprocess_spotting_df(pd.read_csv(spotting_csv))
+            self.spotting_df = self._preprocess_spotting_df(
+                pd.read_csv(spotting_csv, usecols=["game", "gameTime", "label"])
+            )
             assert {"game", "half", "time", "label"}.issubset(set(self.spotting_df.columns))
+            # (game, half) -> (時刻順のアクションの時刻, ラベル)
+            self._action_index = {
+                key: (df["time"].to_numpy(), df["label"].tolist())
+                for key, df in self.spotting_df.sort_values("time", kind="stable").groupby(["game", "half"])
+            }
             
     def get_data(self, game: str, half: int, game_time: int) -> dict[str, str]:
-        result_dict = {
-            "players": None,
-            "actions": None
-        }
+        return self.get_data_all(game, [half], [game_time])[0]
 
-        # self.sec_threshold 秒前 から self.sec_threshold 秒後の間に映っている選手名/teamを取得
-        spot_players_df:pd.DataFrame = self.player_df.loc[
-            (self.player_df["half"] == half) & \
-            (self.player_df["game"] == game) & \
-            (self.player_df["time"] >= game_time - self.sec_window_player) & \
-            (self.player_df["time"] <= game_time + self.sec_window_player)
+    def get_data_all(self, game: str, halves: list[int], game_times: list[int]) -> list[dict[str, str]]:
+        """
+        (halves[i], game_times[i]) ごとに get_data と同じ結果を返す
+        アクションは half ごとに時刻順に並べた配列を、全スポッティングの時刻でまとめて二分探索する
+        """
+        result_dicts = [
+            {"players": self._get_players(game, half, game_time), "actions": None}
+            for half, game_time in zip(halves, game_times)
         ]
-        # team name と player name, jersey number を unique に取得
-        player_dict = (
-            spot_players_df[['name', 'team', 'jersey_number']]
-            .drop_duplicates()
-            .to_dict(orient='records')
-        )
         
         if self.spotting_df is None:
-            result_dict["players"] = player_dict
-            return result_dict
+            return result_dicts
         
         # sec_window 秒前までのアクションを取得
-        spot_action_df: pd.DataFrame = self.spotting_df.loc[
-            (self.spotting_df["half"] == half) & \
-            (self.spotting_df["game"] == game) & \
-            (self.spotting_df["time"] <= game_time) & \
-            (self.spotting_df["time"] >= game_time - self.sec_window)
-        ].sort_values("time", ascending=True)
-        # action を取得
-        actions = spot_action_df["label"].to_list()
-        
-        result_dict["players"] = player_dict
-        result_dict["actions"] = actions
-        return result_dict
+        game_times = np.asarray(game_times)
+        halves = np.asarray(halves)
+        for half in np.unique(halves):
+            positions = np.flatnonzero(halves == half)
+            times, labels = self._action_index.get((game, half), (np.empty(0), []))
+            lo = np.searchsorted(times, game_times[positions] - self.sec_window, side="left")
+            hi = np.searchsorted(times, game_times[positions], side="right")
+            for i, l, h in zip(positions.tolist(), lo.tolist(), hi.tolist()):
+                result_dicts[i]["actions"] = labels[l:h]
+        return result_dicts
+
+    def _get_players(self, game: str, half: int, game_time: int) -> list[dict]:
+        # self.sec_threshold 秒前 から self.sec_threshold 秒後の間に映っている選手名/teamを取得
+        # team name と player name, jersey number を unique に取得
+        if self._player_index is not None:
+            return self._get_players_from_index(game, half, game_time)
+        try:
+            spot_players_df: pd.DataFrame = self.player_df.loc[
+                (game, half, slice(game_time - self.sec_window_player, game_time + self.sec_window_player)), :
+            ]
+        except KeyError:
+            # 該当する (game, half) がない
+            spot_players_df = self.player_df.iloc[:0]
+        return (
+            spot_players_df.sort_values("row")[['name', 'team', 'jersey_number']]
+            .drop_duplicates()
+            .to_dict(orient='records')
+        )
     
+    def _get_players_from_index(self, game: str, half: int, game_time: int) -> list[dict]:
+        """
+        窓内の各秒を _player_index から引き、元の CSV の行順で重複を除いて返す
+        (loc + drop_duplicates と同じ結果)
+        """
+        rows = sorted(
+            (row_record
+            for time in range(game_time - self.sec_window_player, game_time + self.sec_window_player + 1)
+            for row_record in self._player_index.get((game, half, time), ())),
+            key=lambda row_record: row_record[0]
+        )
+        player_dict = {}
+        for _, record in rows:
+            # NaN 同士は == で等しくならないので、drop_duplicates と同じく欠損値を 1 つの値として扱う
+            key = tuple(None if pd.isna(value) else value for value in record.values())
+            player_dict.setdefault(key, record)
+        return [dict(record) for record in player_dict.values()]
+
     def show_player_data(self, game: str, half: int, game_time: int):
         result_dict = self.get_data(game, half, game_time)
         player_dict = result_dict["players"]
@@ -272,25 +434,31 @@ class ReferenceDoc:
         return reference_doc_list
 
     @staticmethod
-    def get_reference_documents(game, half, time, reference_documents: list["ReferenceDoc"]):
-        target_dcument = None
+    def build_index(reference_documents: list["ReferenceDoc"]) -> dict[tuple, "ReferenceDoc"]:
+        """
+        (game, half, time) -> ReferenceDoc の辞書を作る
+        同じキーが複数ある場合は先頭のものを使う
+        """
+        reference_index = {}
         for doc_data in reference_documents:
-            if doc_data.game == game and doc_data.half == half and doc_data.time == time:
-                target_dcument = doc_data.content
-                logger.info(f"Match Reference Document Sample id: {doc_data.id}")
-                break
-        return target_dcument
+            reference_index.setdefault((doc_data.game, doc_data.half, doc_data.time), doc_data)
+        return reference_index
 
     @staticmethod
-    def get_reference_document_entity(game, half, time, reference_documents: list["ReferenceDoc"]):
-        target_doc = None
-        for doc_data in reference_documents:
-            if doc_data.game == game and doc_data.half == half and doc_data.time == time:
-                target_doc = doc_data
-                logger.info(f"Match Reference Document Sample id: {doc_data.id}")
-                break
+    def get_reference_documents(game, half, time, reference_index: dict[tuple, "ReferenceDoc"]):
+        target_doc = ReferenceDoc.get_reference_document_entity(game, half, time, reference_index)
+        return target_doc.content if target_doc is not None else None
+
+    @staticmethod
+    def get_reference_document_entity(game, half, time, reference_index: dict[tuple, "ReferenceDoc"]):
+        target_doc = reference_index.get((game, half, time))
+        if target_doc is not None:
+            logger.info("Match Reference Document Sample id: {}", target_doc.id)
         return target_doc
 
 
 # 型エイリアス 文書スコアの算出方法方法
-RetrieverType = Literal["tfidf", "openai-embedding"]
+RetrieverType = Literal["tfidf", "bm25", "openai-embedding"]
+
+# 型エイリアス openai-embedding で使う FAISS のインデックスの種類
+IndexType = Literal["flat", "hnsw", "ivfpq"]
@@ -2,6 +2,7 @@ from sn_providing.addinfo_retrieval import (
     get_retriever_langchain, 
     PERSIST_LANGCHAIN_DIR,
     RetrieverType,
+    IndexType,
 )
 from sn_providing.entity import CommentDataList
 from tap import Tap
@@ -12,13 +13,15 @@ class Arguments(Tap):
     game: str
     comment_csv: str
     retriever_type: RetrieverType = "tfidf"
+    index_type: IndexType = "flat"
 
 
 if __name__ == "__main__":
     args = Arguments().parse_args()
     retriever = get_retriever_langchain(
         args.retriever_type, 
-        langchain_store_dir=PERSIST_LANGCHAIN_DIR
+        langchain_store_dir=PERSIST_LANGCHAIN_DIR,
+        index_type=args.index_type,
     )
     comment_data_list = CommentDataList.read_csv(args.comment_csv, args.game)
     
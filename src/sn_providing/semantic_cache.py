@@ -0,0 +1,153 @@
+"""
+埋め込みが近いプロンプトに対して、過去の LLM の応答を再利用するキャッシュ
+
+完全一致のキャッシュ (SQLiteCache) では拾えない、言い換えのクエリを対象にする
+"""
+import json
+import threading
+from pathlib import Path
+
+import faiss
+import numpy as np
+from loguru import logger
+from langchain_core.caches import BaseCache
+from langchain_core.embeddings import Embeddings
+from langchain_core.globals import get_llm_cache
+from langchain_core.language_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+
+class SemanticCache:
+    """
+    プロンプトの埋め込み(L2正規化済み)を faiss.IndexFlatIP に保持し、
+    cos類似度が score_threshold 以上の過去のプロンプトがあればその応答を返す
+    (プロンプト, 埋め込み, 応答) は cache_file (jsonl) に追記し、次回の実行でも使う
+    埋め込むのはプロンプトから ignore_prefixes (全リクエスト共通の指示文など) を除いた部分
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache_file: Path,
+        score_threshold: float = 0.95,
+        ignore_prefixes: tuple[str, ...] = ()
+    ):
+        self.embeddings = embeddings
+        self.cache_file = Path(cache_file)
+        self.score_threshold = score_threshold
+        # 長いものから試す (短い接頭辞が長い接頭辞の先頭と一致する場合のため)
+        self.ignore_prefixes = tuple(sorted(ignore_prefixes, key=len, reverse=True))
+
+        self.index: faiss.IndexFlatIP | None = None
+        self.responses: list[str] = []
+        # abatch のスレッドから同時に更新されるため
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def _load(self):
+        if not self.cache_file.exists():
+            return
+        vectors = []
+        with open(self.cache_file) as f:
+            for line in f:
+                data = json.loads(line)
+                vectors.append(data["embedding"])
+                self.responses.append(data["response"])
+        if vectors:
+            self._add(np.asarray(vectors, dtype=np.float32))
+        logger.info("Loaded {} semantic cache entries from {}", len(self.responses), self.cache_file)
+
+    def _add(self, vectors: np.ndarray):
+        if self.index is None:
+            self.index = faiss.IndexFlatIP(vectors.shape[1])
+        self.index.add(vectors)
+
+    @staticmethod
+    def _normalize(vector: list[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _text_to_embed(self, text: str) -> str:
+        # 共通の指示文が入ったままだと、cos類似度がクエリの違いではなく指示文の一致を測ってしまう
+        for prefix in self.ignore_prefixes:
+            if text.startswith(prefix):
+                return text[len(prefix):]
+        return text
+
+    def lookup(self, vector: np.ndarray) -> str | None:
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            scores, ids = self.index.search(vector, 1)
+            if scores[0][0] < self.score_threshold:
+                return None
+            logger.info("Semantic cache hit: score={:.4f}", scores[0][0])
+            return self.responses[ids[0][0]]
+
+    def update(self, prompt: str, vector: np.ndarray, response: str):
+        with self._lock:
+            self._add(vector)
+            self.responses.append(response)
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.cache_file, "a") as f:
+                data = {"prompt": prompt, "embedding": vector[0].tolist(), "response": response}
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def _exact_cache_key(llm: Runnable, prompt: PromptValue | str) -> tuple[BaseCache, str, str] | None:
+        """
+        llm が使う完全一致のキャッシュ (set_llm_cache 等) と、そのキー (prompt, llm_string) を返す
+        キーの作り方は BaseChatModel._generate_with_cache と同じ
+        """
+        if not isinstance(llm, BaseChatModel) or llm.cache is False:
+            return None
+        llm_cache = llm.cache if isinstance(llm.cache, BaseCache) else get_llm_cache()
+        if llm_cache is None:
+            return None
+        messages = llm._convert_input(prompt).to_messages()
+        return llm_cache, dumps(messages), llm._get_llm_string()
+
+    def wrap(self, llm: Runnable) -> Runnable:
+        """
+        llm を呼ぶ前にキャッシュを引く Runnable を返す
+        完全一致のキャッシュにあるプロンプトは埋め込まずにそのまま llm に渡す (llm がキャッシュから返す)
+        それ以外で意味の近いプロンプトがあれば、llm を呼ばずに AIMessage を返す
+        """
+
+        def to_text(prompt: PromptValue | str) -> str:
+            return prompt.to_string() if isinstance(prompt, PromptValue) else prompt
+
+        def invoke(prompt: PromptValue | str, config: RunnableConfig) -> AIMessage:
+            exact_cache_key = self._exact_cache_key(llm, prompt)
+            if exact_cache_key is not None:
+                llm_cache, prompt_key, llm_string = exact_cache_key
+                if llm_cache.lookup(prompt_key, llm_string) is not None:
+                    return llm.invoke(prompt, config)
+            text = to_text(prompt)
+            vector = self._normalize(self.embeddings.embed_query(self._text_to_embed(text)))
+            if (cached := self.lookup(vector)) is not None:
+                return AIMessage(content=cached)
+            response = llm.invoke(prompt, config)
+            self.update(text, vector, response.content)
+            return response
+
+        async def ainvoke(prompt: PromptValue | str, config: RunnableConfig) -> AIMessage:
+            exact_cache_key = self._exact_cache_key(llm, prompt)
+            if exact_cache_key is not None:
+                llm_cache, prompt_key, llm_string = exact_cache_key
+                if await llm_cache.alookup(prompt_key, llm_string) is not None:
+                    return await llm.ainvoke(prompt, config)
+            text = to_text(prompt)
+            vector = self._normalize(await self.embeddings.aembed_query(self._text_to_embed(text)))
+            if (cached := self.lookup(vector)) is not None:
+                return AIMessage(content=cached)
+            response = await llm.ainvoke(prompt, config)
+            self.update(text, vector, response.content)
+            return response
+
+        return RunnableLambda(invoke, afunc=ainvoke, name="SemanticCache")